@@ -1,6 +1,5 @@
 import sys
-import toml
-import shutil
+import logging
 import argparse
 
 def load_config(config_file):
@@ -16,15 +15,25 @@ def load_config(config_file):
         host = '127.0.0.1'       # 服务端模式下为目标转发地址，客户端模式下为服务端 IP
         port = 8080              # 服务端模式下为目标转发端口，客户端模式下为本地监听端口
         mode = 'server'          # server 或 client
+        workers = 64             # 处理新 TCP 连接的工作线程数上限
+        upstream_pool = 0        # 服务端预先建立的目标连接数（TCP），0 为不启用
+        max_connections = 4096   # 同时转发的 TCP 连接数上限，0 为不限制
+        processes = 1            # 工作进程数（需支持 fork 和 SO_REUSEPORT，如 Linux）
     """
     try:
-        config = toml.load(config_file)
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+        with open(config_file, 'rb') as f:
+            config = tomllib.load(f)
         return config
     except Exception as e:
         print(f"加载配置文件 {config_file} 失败: {e}")
         sys.exit(1)
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
     # 默认配置文件名为 config.toml，你也可以通过命令行参数指定
     parser = argparse.ArgumentParser(description='Load config file')
     parser.add_argument('-c', '--config', type=str, default='config.toml', help='Path to config file')
@@ -39,6 +48,7 @@ if __name__ == '__main__':
     except Exception as e:
         if config_file == 'config.toml':
             try:
+                import shutil
                 shutil.copy('config.toml.example', 'config.toml')
                 print("初始化程序配置文件 config.toml，请根据需要修改配置参数.")
                 sys.exit(0)
@@ -62,19 +72,25 @@ if __name__ == '__main__':
     mode       = config.get('mode', 'server').lower()
 
     protocol   = config.get('protocol', 'tcp').lower()
+    workers    = config.get('workers', 64)
+    upstream_pool = config.get('upstream_pool', 0)
+    max_connections = config.get('max_connections', 4096)
+    processes  = config.get('processes', 1)
 
     if mode == 'server':
         # 在服务端模式下，host 与 port 分别为目标转发地址与目标转发端口
         from modules.route.route import Server
         app = Server(interval=interval, extend=extend, base_port=base_port, port_range=port_range,
                         secret=secret, offsets=offsets, target_host=host, target_port=port,
-                        protocol=protocol)
+                        protocol=protocol, workers=workers, upstream_pool=upstream_pool,
+                        max_connections=max_connections, processes=processes)
     elif mode == 'client':
         # 在客户端模式下，host 为服务端 IP，port 为本地监听端口
         from modules.route.route import Client
         app = Client(interval=interval, extend=extend, base_port=base_port, port_range=port_range,
                         secret=secret, offsets=offsets, server_ip=host, local_listen_port=port,
-                        protocol=protocol)
+                        protocol=protocol, workers=workers, max_connections=max_connections,
+                        processes=processes)
     else:
         print("无效的 mode 配置，请设置为 'server' 或 'client'")
         sys.exit(1)
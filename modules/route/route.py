@@ -1,269 +1,1045 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import errno
+import heapq
+import datetime
+import queue
+import os
 import selectors
+import signal
 import socket
 import time
 import threading
-import pyotp
-import toml
+import logging
+import base64
+import hashlib
+import hmac
 import sys
 import concurrent.futures
 
-# 全局线程池，复用线程，最大工作线程数可以根据需要调整
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=200)
+logger = logging.getLogger(__name__)
+
+# UDP 数据报最大长度，按此分配接收缓冲区，避免大数据报被截断
+UDP_BUFSIZE = 65535
+_udp_local = threading.local()
+
+def udp_buffer():
+    """返回当前线程复用的 UDP 接收缓冲区（memoryview），避免每个数据包分配内存"""
+    view = getattr(_udp_local, 'view', None)
+    if view is None:
+        view = _udp_local.view = memoryview(bytearray(UDP_BUFSIZE))
+    return view
+
+UDP_SESSION_TIMEOUT = 60  # UDP 会话空闲多久后关闭（秒）
+UDP_REPLY_TIMEOUT = 5     # 客户端会话从未收到响应时，发出数据后多久仍无响应即换用下一个偏移（秒）
+UDP_BATCH = 64            # 每次唤醒最多连续接收的数据包数
+UDP_RACE_WINDOW = 0.5     # 首个数据包发往多个端口后，收到第一个响应起多久内的其余响应视为副本的响应（秒）
+
+class UdpSession:
+    """
+    UDP 会话：同一客户端地址的数据包复用一个 socket 发往对端，
+    对端的响应由事件循环异步接收，再经 listener 发回客户端
+    """
+    __slots__ = ('sock', 'listener', 'client_addr', 'last_active', 'offset_index', 'racing',
+                 'race_until', 'replied', 'waiting_since')
+
+    def __init__(self, sock, listener, client_addr):
+        self.sock = sock
+        self.listener = listener  # 最近一次收到该客户端数据的 socket，响应从这里发回
+        self.client_addr = client_addr
+        self.last_active = time.monotonic()
+        self.offset_index = 0       # 客户端使用：当前使用的偏移下标
+        self.racing = 0             # 客户端使用：首个数据包额外发出的副本数，其响应尚待丢弃
+        self.race_until = None      # 客户端使用：收到首个响应后，丢弃副本响应的截止时间
+        self.replied = False        # 客户端使用：是否收到过服务器响应
+        self.waiting_since = None   # 客户端使用：尚未收到响应的最早发送时间
+
+def recv_datagrams(sock, buf, limit=UDP_BATCH):
+    """
+    非阻塞地连续接收最多 limit 个数据包，逐个产出 (数据, 地址)，一次唤醒处理一批突发数据。
+    数据是 buf 的切片，须在取下一个数据包前用完
+    """
+    for _ in range(limit):
+        try:
+            n, addr = sock.recvfrom_into(buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        yield buf[:n], addr
+
+def resolve_udp(host, port):
+    """
+    解析 UDP 对端地址，返回 (family, sockaddr)。
+    UDP 转发在事件循环中进行，只在启动时解析一次，避免每个数据包都做 DNS 查询而阻塞循环
+    """
+    family, _, _, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+    return family, sockaddr
+
+def relay_udp_replies(session, buf, accept=None):
+    """把会话 socket 上收到的对端响应转发回客户端；accept(会话, 来源地址) 返回 False 的响应直接丢弃"""
+    try:
+        for data, source in recv_datagrams(session.sock, buf):
+            if accept is not None and not accept(session, source):
+                continue
+            session.last_active = time.monotonic()
+            session.waiting_since = None
+            session.replied = True
+            session.listener.sendto(data, session.client_addr)
+    except OSError as e:
+        logger.debug("转发 UDP 响应至 %s 失败: %s", session.client_addr, e)
+
+def expire_udp_sessions(sessions, sel, now):
+    """关闭空闲超过 UDP_SESSION_TIMEOUT 秒的会话"""
+    for addr, session in list(sessions.items()):
+        if now - session.last_active > UDP_SESSION_TIMEOUT:
+            del sessions[addr]
+            sel.unregister(session.sock)
+            session.sock.close()
+            logger.debug("UDP 会话 %s 空闲超时，已关闭", addr)
 
 def set_tcp_options(sock):
     """
     设置TCP优化参数：禁用Nagle算法，调整收发缓冲区大小
+    （在监听 socket 上设置时，accept 得到的连接会继承这些选项）
     """
     try:
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)  # 64KB
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)  # 64KB
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)  # 1MB
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)  # 1MB
     except Exception:
         pass
 
-def optimized_bidirectional_forward_tcp(conn1, conn2):
+def set_listener_options(sock, reuse_port=False):
     """
-    优化后的TCP双向转发：
-      - 在连接上设置TCP选项
-      - 使用预分配内存和 recv_into 避免频繁分配内存
-      - 利用全局线程池复用线程
+    设置UDP监听socket参数：SO_REUSEADDR；reuse_port 为 True 时再设置 SO_REUSEPORT
+    （允许多个进程监听同一端口，由内核分配数据包）
     """
-    # 为两个连接设置TCP选项
-    set_tcp_options(conn1)
-    set_tcp_options(conn2)
-    
-    BUFSIZE = 8192
-    buf1 = bytearray(BUFSIZE)
-    buf2 = bytearray(BUFSIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except OSError:
+            pass
+
+def create_tcp_listener(port, backlog=4096, reuse_port=False):
+    """
+    创建TCP监听socket：
+      - 支持时使用 IPv4/IPv6 双栈，一个 socket 同时接受两种地址的连接
+      - reuse_port 为 True 时启用 SO_REUSEPORT（多进程共享端口，由内核分配新连接）；
+        默认不启用，端口已被占用时照常报错
+      - 较大的 backlog，避免端口切换时客户端集中重连造成 SYN 丢弃
+    """
+    if socket.has_dualstack_ipv6():
+        s = socket.create_server(('', port), family=socket.AF_INET6, backlog=backlog,
+                                 reuse_port=reuse_port, dualstack_ipv6=True)
+    else:
+        s = socket.create_server(('0.0.0.0', port), backlog=backlog, reuse_port=reuse_port)
+    set_tcp_options(s)
+    return s
+
+# accept 因文件描述符等资源耗尽而失败时，暂停接受新连接的时间（秒）；
+# 监听 socket 仍然可读，若不暂停，select 会立即返回而空转
+ACCEPT_BACKOFF = 1
+ACCEPT_EXHAUSTED = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+# Linux 下可用 splice(2) 经管道在内核内搬运数据，避免复制到用户态
+HAS_SPLICE = hasattr(os, 'splice')
+SPLICE_FLAGS = (os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK) if HAS_SPLICE else 0
+if HAS_SPLICE:
+    import fcntl
+# 转发管道容量上限：管道保持默认容量，只有被读满（批量传输）时才逐步加倍到此大小，
+# 减少 splice 次数；管道容量计入用户的 fs.pipe-user-pages-soft 配额，不为所有连接预先分配
+PIPE_SIZE = 1 << 20
+
+# Linux 下可用 TCP_CORK 暂缓发送不满 MSS 的报文段，批量转发时合并成完整报文段
+HAS_CORK = hasattr(socket, 'TCP_CORK')
 
-    def forward(src, dst, buf):
+def set_tcp_cork(sock, on):
+    """设置 TCP_CORK，成功返回 True；取消时内核立即发出积攒的数据"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
+        return True
+    except OSError:
+        return False
+
+class ForwardReactor:
+    """
+    TCP 转发反应器：
+      - 所有转发连接对共用一个 selectors 事件循环（Linux 下为 epoll）和一个后台线程
+      - Linux 下每个方向经一个管道用 splice 零拷贝转发；其他平台使用
+        预分配缓冲区和 recv_into，避免频繁分配内存
+      - 目标端暂时不可写时保留未发送数据，并改为等待可写事件
+    """
+    BUFSIZE = 65536
+    PUMP_BATCH = 16
+
+    class _Flow:
+        """单向数据流：从 src 读取，写入 dst"""
+        __slots__ = ('src', 'dst', 'pipe', 'buf', 'view', 'chunk', 'can_grow', 'start', 'end', 'eof')
+
+        def __init__(self, src, dst, bufsize):
+            self.src = src
+            self.dst = dst
+            self.pipe = None  # (读端, 写端)，使用 splice 时有效
+            self.buf = None
+            self.view = None
+            self.chunk = bufsize  # 每次读取的最大字节数
+            self.can_grow = False  # 管道是否还可以扩容
+            self.start = 0    # 未发送数据的起止位置（splice 时 end - start 为管道中的字节数）
+            self.end = 0
+            self.eof = False
+            if HAS_SPLICE:
+                try:
+                    self.pipe = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+                except OSError:
+                    pass
+                else:
+                    self.chunk = fcntl.fcntl(self.pipe[1], fcntl.F_GETPIPE_SZ)
+                    self.can_grow = self.chunk < PIPE_SIZE
+            if self.pipe is None:
+                self.use_buffer(bufsize)
+
+        def use_buffer(self, bufsize):
+            """改用用户态缓冲区转发"""
+            self.close_pipe()
+            self.buf = bytearray(bufsize)
+            self.view = memoryview(self.buf)
+            self.chunk = bufsize
+            self.can_grow = False
+
+        def grow_pipe(self):
+            """管道被读满时容量加倍（最多 PIPE_SIZE）；超出 pipe-max-size 或用户配额时不再尝试"""
+            try:
+                self.chunk = fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, min(self.chunk * 2, PIPE_SIZE))
+            except OSError:
+                self.can_grow = False
+                return
+            self.can_grow = self.chunk < PIPE_SIZE
+
+        def close_pipe(self):
+            if self.pipe is not None:
+                for fd in self.pipe:
+                    os.close(fd)
+                self.pipe = None
+
+    class _Pair:
+        """一对互相转发的连接"""
+        __slots__ = ('flows', 'on_close', 'closed')
+
+        def __init__(self, conn1, conn2, bufsize, on_close):
+            self.flows = (ForwardReactor._Flow(conn1, conn2, bufsize),
+                          ForwardReactor._Flow(conn2, conn1, bufsize))
+            self.on_close = on_close
+            self.closed = False
+
+    class _Connecting:
+        """正在非阻塞连接上游的转发请求"""
+        __slots__ = ('conn', 'addrs', 'timeout', 'stagger', 'pending', 'error',
+                     'on_close', 'on_error')
+
+        def __init__(self, conn, addrs, timeout, stagger, on_close, on_error):
+            self.conn = conn
+            self.addrs = addrs  # 尚未尝试的 getaddrinfo 结果
+            self.timeout = timeout  # 单个地址的连接超时（秒），None 为不限
+            self.stagger = stagger  # 上一个地址未连上时，间隔多久并行尝试下一个（秒），None 为不并行
+            self.pending = {}   # 正在连接的 socket -> 地址
+            self.error = None
+            self.on_close = on_close
+            self.on_error = on_error
+
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._incoming = []  # 待在反应器线程中执行的 (函数, 参数)
+        self._timers = []    # 定时任务的最小堆：(单调时钟到期时间, 序号, 函数, 参数)
+        self._timer_seq = 0
+        self._thread = None
+        # 用于从其他线程唤醒 select 的 socket 对
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.sel.register(self._wakeup_r, selectors.EVENT_READ)
+
+    def register_pair(self, conn1, conn2, on_close=None):
+        """
+        将一对已建立的连接交给反应器双向转发，调用方无需等待。
+        两端都结束后由反应器关闭连接，并调用 on_close()
+        """
+        conn1.setblocking(False)
+        conn2.setblocking(False)
+        self._call_soon(self._add_pair, self._Pair(conn1, conn2, self.BUFSIZE, on_close))
+
+    def connect_pair(self, conn, addresses, on_close=None, on_error=None, timeout=None, stagger=None):
+        """
+        非阻塞地依次尝试连接 addresses 中的 (host, port)，第一个建立的连接与 conn
+        组成转发对，调用方无需等待连接完成。每个地址最多等待 timeout 秒；
+        指定 stagger 时，上一个地址 stagger 秒内未连上即同时尝试下一个，先连上者胜出，其余关闭。
+        全部失败时关闭 conn，并调用 on_error(最后一次的异常)；地址解析失败时直接抛出异常
+        """
+        addrs = []
+        for host, port in addresses:
+            addrs.extend(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+        conn.setblocking(False)
+        self._call_soon(self._start_connect,
+                        self._Connecting(conn, addrs, timeout, stagger, on_close, on_error))
+
+    def close(self):
+        """释放反应器的 selector 和唤醒 socket（仅用于未启动线程的反应器）"""
+        self.sel.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def _call_soon(self, func, arg):
+        """在反应器线程中执行 func(arg)，必要时启动反应器线程"""
+        with self._lock:
+            self._incoming.append((func, arg))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='forward-reactor', daemon=True)
+                self._thread.start()
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _loop(self):
         while True:
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.monotonic())
+            for key, mask in self.sel.select(timeout):
+                if key.fileobj is self._wakeup_r:
+                    self._drain_wakeup()
+                    continue
+                if isinstance(key.data, self._Connecting):
+                    self._finish_connect(key.data, key.fileobj)
+                    continue
+                pair, reading, writing = key.data
+                if pair.closed:
+                    continue
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(writing)
+                    if mask & selectors.EVENT_READ:
+                        self._pump(reading)
+                    self._rearm(pair)
+                except OSError:
+                    self._close(pair)
+            self._expire_timers()
+
+    def _call_later(self, delay, func, arg):
+        """delay 秒后在反应器线程中执行 func(arg)（仅在反应器线程中调用）"""
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (time.monotonic() + delay, self._timer_seq, func, arg))
+
+    def _expire_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, func, arg = heapq.heappop(self._timers)
+            func(arg)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+        for func, arg in incoming:
+            func(arg)
+
+    def _add_pair(self, pair):
+        f12, f21 = pair.flows
+        try:
+            self.sel.register(f12.src, selectors.EVENT_READ, data=(pair, f12, f21))
+            self.sel.register(f21.src, selectors.EVENT_READ, data=(pair, f21, f12))
+        except (OSError, ValueError):
+            self._close(pair)
+
+    def _start_connect(self, c):
+        """
+        从剩余地址中发起下一个非阻塞连接并等待可写事件；
+        没有可尝试的地址且没有正在进行的连接时，视为全部失败
+        """
+        while c.addrs:
+            family, type_, proto, _, sockaddr = c.addrs.pop(0)
+            upstream = None
             try:
-                n = src.recv_into(buf)
-                if n == 0:
-                    break
-                dst.sendall(buf[:n])
+                upstream = socket.socket(family, type_, proto)
+                upstream.setblocking(False)
+                set_tcp_options(upstream)
+                err = upstream.connect_ex(sockaddr)
+                if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', -1)):
+                    c.pending[upstream] = sockaddr
+                    self.sel.register(upstream, selectors.EVENT_WRITE, data=c)
+                    if c.timeout is not None:
+                        self._call_later(c.timeout, self._connect_timeout, (c, upstream))
+                    if c.stagger is not None and c.addrs:
+                        self._call_later(c.stagger, self._connect_next, c)
+                    return
+                c.error = OSError(err, os.strerror(err))
+            except OSError as e:
+                c.error = e
+            logger.debug("连接 %s 失败: %s", sockaddr, c.error)
+            if upstream is not None:
+                upstream.close()
+        if c.pending:
+            return
+        c.conn.close()
+        if c.on_error is not None:
+            try:
+                c.on_error(c.error)
             except Exception:
-                break
+                pass
+
+    def _connect_next(self, c):
+        """错开时间到：之前的连接仍未完成，并行尝试下一个地址"""
+        if c.pending and c.addrs:
+            self._start_connect(c)
+
+    def _connect_timeout(self, arg):
+        """连接超时的地址视为失败，继续尝试下一个地址"""
+        c, upstream = arg
+        sockaddr = c.pending.pop(upstream, None)
+        # 已连接成功或已失败的连接直接忽略
+        if sockaddr is None:
+            return
+        self.sel.unregister(upstream)
+        upstream.close()
+        c.error = TimeoutError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT))
+        logger.debug("连接 %s 失败: %s", sockaddr, c.error)
+        self._start_connect(c)
+
+    def _finish_connect(self, c, upstream):
+        sockaddr = c.pending.pop(upstream, None)
+        # 同一批就绪事件中，已被胜出者关闭的连接直接忽略
+        if sockaddr is None:
+            return
+        self.sel.unregister(upstream)
+        err = upstream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            c.error = OSError(err, os.strerror(err))
+            logger.debug("连接 %s 失败: %s", sockaddr, c.error)
+            upstream.close()
+            self._start_connect(c)
+            return
+        # 先连上者胜出，关闭其余仍在进行的连接，不再尝试剩余地址
+        for other in c.pending:
+            self.sel.unregister(other)
+            other.close()
+        c.pending.clear()
+        c.addrs = []
+        self._add_pair(self._Pair(c.conn, upstream, self.BUFSIZE, c.on_close))
+
+    def _pump(self, flow):
+        """
+        从 src 读取数据并尽量写入 dst，写不完的部分留待可写时发送。
+        读满整个管道/缓冲区说明内核中可能还有数据，此时继续读取（最多 PUMP_BATCH 次），
+        省去再次进入 select 的系统调用；继续读取期间对 dst 设置 TCP_CORK，
+        避免把批量数据拆成许多小报文段，结束时取消以立即发出剩余数据
+        """
+        corked = False
         try:
-            dst.shutdown(socket.SHUT_WR)
-        except Exception:
-            pass
+            for _ in range(self.PUMP_BATCH):
+                try:
+                    n = self._read(flow)
+                except (BlockingIOError, InterruptedError):
+                    return
+                if n == 0:
+                    flow.eof = True
+                    try:
+                        flow.dst.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+                    return
+                flow.start, flow.end = 0, n
+                self._flush(flow)
+                if flow.start < flow.end or n < flow.chunk:
+                    return
+                if flow.can_grow:
+                    flow.grow_pipe()
+                if HAS_CORK and not corked:
+                    corked = set_tcp_cork(flow.dst, True)
+        finally:
+            if corked:
+                set_tcp_cork(flow.dst, False)
 
-    future1 = executor.submit(forward, conn1, conn2, buf1)
-    future2 = executor.submit(forward, conn2, conn1, buf2)
-    concurrent.futures.wait([future1, future2])
+    def _read(self, flow):
+        """读取一块数据到管道或缓冲区，返回字节数，0 表示对端已关闭写"""
+        if flow.pipe is not None:
+            try:
+                return os.splice(flow.src.fileno(), flow.pipe[1], flow.chunk, flags=SPLICE_FLAGS)
+            except OSError as e:
+                # 该 socket 不支持 splice（此时管道必为空），退回缓冲区方式
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                flow.use_buffer(self.BUFSIZE)
+        return flow.src.recv_into(flow.buf)
+
+    def _flush(self, flow):
+        """发送管道或缓冲区中剩余的数据"""
+        while flow.start < flow.end:
+            try:
+                if flow.pipe is not None:
+                    flow.start += os.splice(flow.pipe[0], flow.dst.fileno(),
+                                            flow.end - flow.start, flags=SPLICE_FLAGS)
+                else:
+                    flow.start += flow.dst.send(flow.view[flow.start:flow.end])
+            except (BlockingIOError, InterruptedError):
+                return
+        flow.start = flow.end = 0
+
+    def _rearm(self, pair):
+        """根据各方向的状态重新设置两端关注的事件"""
+        f12, f21 = pair.flows
+        if f12.eof and f21.eof:
+            self._close(pair)
+            return
+        for reading, writing in ((f12, f21), (f21, f12)):
+            events = 0
+            if not reading.eof and reading.start == reading.end:
+                events |= selectors.EVENT_READ
+            if writing.start < writing.end:
+                events |= selectors.EVENT_WRITE
+            sock = reading.src
+            try:
+                key = self.sel.get_key(sock)
+            except KeyError:
+                key = None
+            if events == 0:
+                if key is not None:
+                    self.sel.unregister(sock)
+            elif key is None:
+                self.sel.register(sock, events, data=(pair, reading, writing))
+            elif key.events != events:
+                self.sel.modify(sock, events, data=(pair, reading, writing))
+
+    def _close(self, pair):
+        if pair.closed:
+            return
+        pair.closed = True
+        for flow in pair.flows:
+            try:
+                self.sel.unregister(flow.src)
+            except (KeyError, ValueError):
+                pass
+            flow.src.close()
+            flow.close_pipe()
+        if pair.on_close is not None:
+            try:
+                pair.on_close()
+            except Exception:
+                pass
+
+# 全局转发反应器，所有TCP转发连接对共用
+reactor = ForwardReactor()
+
+def reset_reactor():
+    """
+    fork 后在子进程中调用：继承的反应器与父进程共用同一个 epoll 实例，
+    换用新的反应器，并关闭继承来的描述符
+    """
+    global reactor
+    old, reactor = reactor, ForwardReactor()
+    old.close()
+
+def optimized_bidirectional_forward_tcp(conn1, conn2, on_close=None):
+    """
+    优化后的TCP双向转发：
+      - 在连接上设置TCP选项
+      - 交给全局转发反应器处理，不再为每个连接占用线程
+      - 转发结束后连接由反应器关闭，并调用 on_close()
+    """
+    # 为两个连接设置TCP选项
+    set_tcp_options(conn1)
+    set_tcp_options(conn2)
+    reactor.register_pair(conn1, conn2, on_close)
+
+def optimized_forward_tcp_to(conn, addresses, on_close=None, on_error=None, timeout=None, stagger=None):
+    """
+    非阻塞地依次尝试连接 addresses 中的 (host, port)，成功后与 conn 双向转发：
+      - 连接过程同样由全局转发反应器处理，不占用调用线程
+      - 每个地址最多等待 timeout 秒；指定 stagger 时错开时间并行尝试后续地址
+      - 全部失败时关闭 conn，并调用 on_error(异常)
+    """
+    set_tcp_options(conn)
+    reactor.connect_pair(conn, addresses, on_close, on_error, timeout, stagger)
 
 ###############################################################################
-# Server 类（TCP/UDP均支持，这里TCP部分做了优化）
+# Server/Client 公共部分：TOTP 端口计算、工作线程池
 ###############################################################################
-class Server:
+class TotpRoute:
     """
-    服务端中间件类：
-      - 根据 TOTP 算法动态监听端口（统一使用 protocol）
-      - 当有客户端接入时，通过 protocol 将数据转发至目标地址（目标程序）
+    Server 与 Client 的公共基类：
+      - 保存 TOTP 参数，预计算后续窗口的动态端口
+      - 持有处理新连接/数据包的有界线程池
+      - 限制同时转发的 TCP 连接数
+      - 可按 processes 启动多个工作进程，借助 SO_REUSEPORT 由内核分配连接
     """
+    SCHEDULE_WINDOWS = 120  # 每次预计算的窗口数
+    SCHEDULE_REFILL = 10    # 剩余窗口少于此数时重新预计算
+
     def __init__(self, interval, extend, base_port, port_range, secret, offsets,
-                 target_host, target_port, protocol):
+                 protocol, workers=64, max_connections=4096, processes=1):
         self.interval = interval
         self.extend = extend
         self.base_port = base_port
         self.port_range = port_range
         self.secret = secret
         self.offsets = offsets
-        self.target_host = target_host
-        self.target_port = target_port
 
         self.protocol = protocol.lower()
         if self.protocol not in ["tcp", "udp"]:
             raise ValueError("protocol 参数只支持 tcp 或 udp")
 
-        self.sockets = {}  # offset -> (sock, valid_start, valid_end, port)
+        # 有界线程池，复用工作线程处理新连接/数据包
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fwd')
+        # TCP 连接数上限，超出时直接关闭新连接；为 0 时不限制
+        self._conn_slots = threading.BoundedSemaphore(max_connections) if max_connections > 0 else None
+        self.processes = processes
+        # 仅在多进程运行时才让监听 socket 共享端口
+        self.reuse_port = processes > 1 and hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
         self.sel = selectors.DefaultSelector()
 
-    def get_window_params(self, offset):
+        # base32 密钥只解码一次（与 pyotp 一致：补齐填充、忽略大小写）
+        self._key = base64.b32decode(secret + '=' * (-len(secret) % 8), casefold=True)
+        # 密钥固定，HMAC 的内外填充块只计算一次，每次 copy() 后再输入计数器
+        self._hmac = hmac.new(self._key, digestmod=hashlib.sha1)
+        # 预计算的端口表：(起始计数器, [端口, ...])，窗口连续，按下标查询
+        self._schedule = (0, [])
+        self._rebuild_schedule(int(time.time()) // self.interval)
+
+    def _totp_counter(self, counter):
+        """RFC 4226 HOTP：HMAC-SHA1 + 动态截断，取 6 位十进制数"""
+        h = self._hmac.copy()
+        h.update(counter.to_bytes(8, 'big'))
+        d = h.digest()
+        o = d[19] & 0x0f
+        return ((d[o] & 0x7f) << 24 | d[o + 1] << 16 | d[o + 2] << 8 | d[o + 3]) % 1_000_000
+
+    def _port_for_counter(self, counter):
         """
-        根据当前时间加上偏移，计算 TOTP 窗口起始时间、有效期及映射端口  
-        有效期：窗口开始前 extend 秒 到窗口结束后 extend 秒
+        返回 TOTP 计数器（窗口序号）对应的端口。
+        端口表一次预计算 SCHEDULE_WINDOWS 个连续窗口，查询只需一次下标运算；
+        剩余窗口不足 SCHEDULE_REFILL 个或超出范围时重新计算
         """
-        now = time.time()
-        t = now + offset
-        window_start = (int(t) // self.interval) * self.interval
-        valid_start = window_start - self.extend
-        valid_end   = window_start + self.interval + self.extend
+        base, ports = self._schedule
+        i = counter - base
+        if 0 <= i < len(ports) - self.SCHEDULE_REFILL:
+            return ports[i]
+        return self._rebuild_schedule(counter)
 
-        totp = pyotp.TOTP(self.secret, interval=self.interval)
-        otp = totp.at(window_start)
-        port_offset = int(otp) % self.port_range
-        port = self.base_port + port_offset
+    def _rebuild_schedule(self, counter):
+        """从 counter 之前若干窗口（覆盖所有偏移）开始重新计算端口表，返回 counter 对应的端口"""
+        back = (max(self.offsets, default=0) - min(self.offsets, default=0)) // self.interval + 2
+        base = max(0, counter - int(back))  # 计数器不能为负（8 字节无符号大端编码）
+        ports = [self.base_port + self._totp_counter(c) % self.port_range
+                 for c in range(base, base + self.SCHEDULE_WINDOWS)]
+        self._schedule = (base, ports)
+        return ports[counter - base]
+
+    def acquire_connection(self):
+        """占用一个连接名额，已达上限时返回 False（不等待）"""
+        return self._conn_slots is None or self._conn_slots.acquire(blocking=False)
+
+    def release_connection(self):
+        """连接转发结束或失败后归还名额"""
+        if self._conn_slots is not None:
+            self._conn_slots.release()
+
+    def fork_workers(self):
+        """
+        再启动 processes - 1 个子进程，各自独立运行监听与端口轮换，不共享状态；
+        监听 socket 均启用 SO_REUSEPORT，由内核在进程间分配连接/数据包。
+        返回子进程 pid 列表（子进程中为空列表）
+        """
+        if self.processes <= 1:
+            return []
+        if not self.reuse_port:
+            logger.warning("当前平台不支持 fork 或 SO_REUSEPORT，processes 配置无效，仅使用单进程运行")
+            return []
+        children = []
+        for _ in range(self.processes - 1):
+            pid = os.fork()
+            if pid == 0:
+                # 子进程：继承的 epoll 与父进程共用，需换用新的 selector
+                self.sel.close()
+                self.sel = selectors.DefaultSelector()
+                reset_reactor()
+                return []
+            children.append(pid)
+        # 父进程收到 SIGTERM 时正常退出，以便在 run() 中结束子进程（只能在主线程设置）
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logger.info("已启动 %d 个工作进程", self.processes)
+        return children
+
+    def run(self):
+        children = self.fork_workers()
+        try:
+            if self.protocol == "tcp":
+                self.run_tcp()
+            elif self.protocol == "udp":
+                self.run_udp()
+        finally:
+            self.pool.shutdown(wait=False)
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+###############################################################################
+# Server 类（TCP/UDP均支持，这里TCP部分做了优化）
+###############################################################################
+class Server(TotpRoute):
+    """
+    服务端中间件类：
+      - 根据 TOTP 算法动态监听端口（统一使用 protocol）
+      - 当有客户端接入时，通过 protocol 将数据转发至目标地址（目标程序）
+    """
+    class _Slot:
+        """某个 TOTP 窗口的监听 socket 及其监听时段（墙上时钟）"""
+        __slots__ = ('sock', 'counter', 'port', 'valid_start', 'valid_end')
+
+        def __init__(self, sock, counter, port, valid_start, valid_end):
+            self.sock = sock
+            self.counter = counter
+            self.port = port
+            self.valid_start = valid_start
+            self.valid_end = valid_end
+
+    def __init__(self, interval, extend, base_port, port_range, secret, offsets,
+                 target_host, target_port, protocol, workers=64, upstream_pool=0,
+                 max_connections=4096, processes=1):
+        super().__init__(interval, extend, base_port, port_range, secret, offsets,
+                         protocol, workers, max_connections, processes)
+        self.target_host = target_host
+        self.target_port = target_port
+
+        # 预先建立的目标连接池（TCP），为 0 时不启用
+        self.upstream_pool = upstream_pool
+        self._upstream_conns = queue.SimpleQueue()
+        self._upstream_wanted = threading.Event()
+
+        self.sockets = {}  # TOTP 计数器 -> _Slot，相邻窗口的监听时段可以重叠
+        self._events = []  # 窗口事件的最小堆：(到期时间, 计数器, 是否为打开监听)
+        self._next_counter = 0  # 下一个尚未安排打开的窗口
+        self._clock_offset = 0  # 安排窗口事件时墙上时钟与单调时钟之差，用于发现系统时间跳变
+        self._paused = []  # 暂停接受连接的监听 socket：[(恢复时间, sock, 注册数据), ...]
+        self._udp_sessions = {}  # 客户端地址 -> UdpSession
+        self._udp_buf = None     # UDP 接收缓冲区，在 run_udp 中分配
+        self._udp_target = None  # 解析后的目标地址 (family, sockaddr)，在 run_udp 中解析
+
+    def get_window_params(self, counter):
+        """
+        计算 TOTP 窗口 counter 的映射端口及监听时段（墙上时钟）：
+        窗口有效期为窗口开始前 extend 秒到窗口结束后 extend 秒，
+        任一偏移下进入有效期时开始监听，所有偏移下都超出有效期后停止
+        """
+        window_start = counter * self.interval
+        valid_start = window_start - self.extend - max(self.offsets, default=0)
+        valid_end   = window_start + self.interval + self.extend - min(self.offsets, default=0)
+
+        port = self._port_for_counter(counter)
 
         return port, valid_start, valid_end
 
     def create_tcp_socket(self, port):
         """创建TCP监听socket（非阻塞）"""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s = create_tcp_listener(port, reuse_port=self.reuse_port)
         s.setblocking(False)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(('0.0.0.0', port))
-        s.listen(5)
         return s
 
     def create_udp_socket(self, port):
         """创建UDP socket（非阻塞）"""
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.setblocking(False)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        set_listener_options(s, self.reuse_port)
         s.bind(('0.0.0.0', port))
         return s
 
-    def handle_tcp_connection(self, client_conn, offset, listening_port):
+    def refill_upstream_pool(self):
+        """
+        后台线程：保持预连接池中有 upstream_pool 个已建立的目标连接，
+        新客户端接入时可直接转发，省去一次到目标的 TCP 握手
+        """
+        while True:
+            self._upstream_wanted.wait(timeout=5)
+            self._upstream_wanted.clear()
+            while self._upstream_conns.qsize() < self.upstream_pool:
+                try:
+                    conn = socket.create_connection((self.target_host, self.target_port), timeout=5)
+                except OSError as e:
+                    logger.warning("预连接目标 %s:%d 失败: %s", self.target_host, self.target_port, e)
+                    break
+                set_tcp_options(conn)
+                conn.setblocking(False)
+                self._upstream_conns.put(conn)
+
+    def take_upstream(self):
+        """从预连接池取出一个仍然可用的目标连接，池为空时返回 None"""
+        while True:
+            try:
+                conn = self._upstream_conns.get_nowait()
+            except queue.Empty:
+                return None
+            self._upstream_wanted.set()
+            try:
+                # 对端已关闭时读到 b''；已有数据（如 SSH 欢迎信息）或暂无数据时仍可使用
+                if conn.recv(1, socket.MSG_PEEK) == b'':
+                    conn.close()
+                    continue
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                conn.close()
+                continue
+            return conn
+
+    def handle_tcp_connection(self, client_conn, counter, listening_port):
         """
         TCP处理函数：客户端通过TOTP动态端口连接后，
-        建立到目标地址的TCP连接，并启动双向转发（使用优化后的转发函数）
+        优先使用预连接池中的目标连接，否则由转发反应器非阻塞地连接目标地址，
+        并启动双向转发，工作线程不等待连接建立
         """
-        print(f"[{time.strftime('%H:%M:%S')}] 收到 {client_conn.getpeername()} 的连接（偏移 {offset}，端口 {listening_port}）")
+        # getpeername() 是一次系统调用，仅在需要输出调试日志时调用
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("收到 %s 的连接（窗口 %d，端口 %d）", client_conn.getpeername(), counter, listening_port)
+
+        def on_close():
+            logger.debug("连接关闭，转发结束。")
+            self.release_connection()
+
+        def on_error(e):
+            logger.warning("连接目标 %s:%d 失败: %s", self.target_host, self.target_port, e)
+            self.release_connection()
+
+        target_conn = self.take_upstream()
+        if target_conn is not None:
+            optimized_bidirectional_forward_tcp(client_conn, target_conn, on_close=on_close)
+            return
+
         try:
-            target_conn = socket.create_connection((self.target_host, self.target_port))
-            set_tcp_options(target_conn)
+            optimized_forward_tcp_to(
+                client_conn, [(self.target_host, self.target_port)],
+                on_close=on_close, on_error=on_error)
         except Exception as e:
-            print(f"连接目标 {self.target_host}:{self.target_port} 失败: {e}")
+            on_error(e)
             client_conn.close()
-            return
 
-        optimized_bidirectional_forward_tcp(client_conn, target_conn)
-        client_conn.close()
-        target_conn.close()
-        print(f"[{time.strftime('%H:%M:%S')}] 连接关闭，转发结束。")
-
-    def handle_udp_packet(self, sock, data, client_addr, offset, listening_port):
+    def handle_udp_packet(self, sock, data, client_addr, counter, listening_port):
         """
-        UDP处理函数：收到UDP数据包后，
-        通过UDP将数据发送到目标地址，再将目标响应转发回客户端。
+        UDP处理函数（在事件循环中执行）：收到UDP数据包后，
+        经该客户端的会话 socket（已 connect 到目标地址）发送到目标，
+        目标响应由事件循环异步转发回客户端，无需阻塞等待
         """
-        print(f"[{time.strftime('%H:%M:%S')}] 收到来自 {client_addr} 的 UDP 数据包（偏移 {offset}，端口 {listening_port}）")
+        logger.debug("收到来自 %s 的 UDP 数据包（窗口 %d，端口 %d）", client_addr, counter, listening_port)
         try:
-            target_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            target_sock.settimeout(5)
-            target_sock.sendto(data, (self.target_host, self.target_port))
-            response, _ = target_sock.recvfrom(4096)
-            sock.sendto(response, client_addr)
-            print(f"[{time.strftime('%H:%M:%S')}] UDP 转发成功")
+            session = self._udp_sessions.get(client_addr)
+            if session is None:
+                family, sockaddr = self._udp_target
+                target_sock = socket.socket(family, socket.SOCK_DGRAM)
+                try:
+                    target_sock.setblocking(False)
+                    target_sock.connect(sockaddr)
+                    session = UdpSession(target_sock, sock, client_addr)
+                    self.sel.register(target_sock, selectors.EVENT_READ, data=(self._relay_replies, session))
+                except Exception:
+                    target_sock.close()
+                    raise
+                self._udp_sessions[client_addr] = session
+            # 客户端切换端口后，响应从其最近使用的端口发回
+            session.listener = sock
+            session.last_active = time.monotonic()
+            session.sock.send(data)
         except Exception as e:
-            print(f"UDP 转发出错: {e}")
+            logger.warning("UDP 转发出错: %s", e)
 
-    def run(self):
-        if self.protocol == "tcp":
-            self.run_tcp()
-        elif self.protocol == "udp":
-            self.run_udp()
+    def _rotate_windows(self, now, create_socket, on_ready):
+        """
+        处理已到期的窗口事件：窗口进入监听时段前就创建并注册它的监听 socket，
+        与仍在有效期内的上一个窗口同时监听，超出监听时段后再关闭，切换时不会出现无人监听的间隙。
+        socket 就绪时由事件循环调用 on_ready(sock, slot)
+        """
+        wall = time.time()
+        while self._events[0][0] <= now:
+            _, counter, opening = heapq.heappop(self._events)
+            if not opening:
+                slot = self.sockets.pop(counter, None)
+                if slot and not self._slot_in_use(slot):
+                    try:
+                        self.sel.unregister(slot.sock)
+                    except Exception:
+                        pass
+                    slot.sock.close()
+                    logger.debug("关闭旧 %s socket（窗口 %d，端口 %d）", self.protocol.upper(), counter, slot.port)
+                continue
 
-    def run_tcp(self):
-        print("服务端中间件启动（TCP），动态监听 TOTP 端口并转发数据到目标...")
+            port, valid_start, valid_end = self.get_window_params(counter)
+            if counter == self._next_counter:
+                # 安排下一个窗口的打开时间（换算为单调时钟）
+                self._next_counter += 1
+                next_start = self.get_window_params(self._next_counter)[1]
+                heapq.heappush(self._events, (now + next_start - wall, self._next_counter, True))
+            if valid_end <= wall:
+                continue
+            shared = next((slot for slot in self.sockets.values() if slot.port == port), None)
+            if shared is not None:
+                # 与仍在监听的窗口映射到同一端口：沿用其 socket，直到两个窗口都超出监听时段才关闭
+                shared.valid_end = max(shared.valid_end, valid_end)
+                self.sockets[counter] = shared
+                heapq.heappush(self._events, (now + valid_end - wall, counter, False))
+                logger.debug("窗口 %d 与窗口 %d 端口相同（%d），沿用已有 socket", counter, shared.counter, port)
+                continue
+            try:
+                s = create_socket(port)
+                slot = self._Slot(s, counter, port, valid_start, valid_end)
+                self.sel.register(s, selectors.EVENT_READ, data=(on_ready, slot))
+                self.sockets[counter] = slot
+                heapq.heappush(self._events, (now + valid_end - wall, counter, False))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("创建 %s socket（窗口 %d，端口 %d），监听至 %s", self.protocol.upper(),
+                                 counter, port, datetime.datetime.fromtimestamp(valid_end))
+            except Exception as e:
+                logger.warning("创建 %s 端口 %d 失败: %s", self.protocol.upper(), port, e)
+                # 创建失败时稍后重试
+                heapq.heappush(self._events, (now + 5, counter, True))
+
+    def _slot_in_use(self, slot):
+        """监听 socket 是否仍被某个窗口使用（相邻窗口端口相同时共用一个 socket）"""
+        return any(s is slot for s in self.sockets.values())
+
+    def _reset_windows(self):
+        """关闭所有监听 socket，从可能仍在监听时段内的最早窗口开始重新安排窗口事件"""
+        for slot in set(self.sockets.values()):
+            try:
+                self.sel.unregister(slot.sock)
+            except Exception:
+                pass
+            slot.sock.close()
+        self.sockets.clear()
+        self._paused.clear()
+        wall = time.time()
+        self._clock_offset = wall - time.monotonic()
+        first = int(wall + min(self.offsets, default=0) - self.extend) // self.interval - 1
+        self._next_counter = first
+        self._events = [(0, first, True)]
+
+    def _serve(self, create_socket, on_ready, on_tick=None):
+        """
+        TCP/UDP 共用的事件循环：按窗口事件打开/关闭监听 socket，等待 socket 就绪。
+        注册到 selector 的 socket 均附带 (回调, 参数)，就绪时调用 回调(socket, 参数)；
+        on_tick(now) 用于周期性工作，返回下次调用的单调时钟时间
+        """
+        self._reset_windows()
+        tick_due = 0 if on_tick is not None else float('inf')
+        # 至少每隔这么久醒来一次检查系统时间是否跳变
+        clock_check = min(max(self.extend, 1), 5)
         while True:
-            now = time.time()
-            next_timeout = 5
-
-            # 更新或创建各偏移对应的监听 socket
-            for offset in self.offsets:
-                port, valid_start, valid_end = self.get_window_params(offset)
-                info = self.sockets.get(offset)
-                if info:
-                    sock, old_valid_start, old_valid_end, old_port = info
-                    if now >= old_valid_end or port != old_port:
-                        try:
-                            self.sel.unregister(sock)
-                        except Exception:
-                            pass
-                        sock.close()
-                        print(f"[{time.strftime('%H:%M:%S')}] 关闭旧 socket（偏移 {offset}，端口 {old_port}）")
-                        del self.sockets[offset]
-                        info = None
-                if not info:
-                    if now >= valid_start:
-                        try:
-                            s = self.create_tcp_socket(port)
-                            self.sel.register(s, selectors.EVENT_READ, data=offset)
-                            self.sockets[offset] = (s, valid_start, valid_end, port)
-                            print(f"[{time.strftime('%H:%M:%S')}] 创建监听 socket（偏移 {offset}，端口 {port}），有效期至 {time.strftime('%H:%M:%S', time.localtime(valid_end))}")
-                        except Exception as e:
-                            print(f"创建端口 {port} 失败: {e}")
-                    else:
-                        next_timeout = min(next_timeout, valid_start - now)
-
-            for offset, (s, valid_start, valid_end, port) in self.sockets.items():
-                next_timeout = min(next_timeout, valid_end - now)
-
-            if not self.sockets:
+            # 事件时间使用单调时钟，不受系统时间调整影响；TOTP 窗口本身仍按墙上时钟计算
+            now = time.monotonic()
+            drift = time.time() - now - self._clock_offset
+            if abs(drift) > 1:
+                # 系统时间被调整（NTP 校时、虚拟机恢复等）：已安排的窗口事件失效，按当前时间重新安排
+                logger.warning("系统时间跳变 %.1f 秒，重新计算监听端口", drift)
+                self._reset_windows()
+            self._rotate_windows(now, create_socket, on_ready)
+            if now >= tick_due:
+                tick_due = on_tick(now)
+
+            if self._paused:
+                self._resume_listeners(now)
+
+            next_timeout = min(self._events[0][0], tick_due, now + clock_check)
+            if self._paused:
+                next_timeout = min(next_timeout, min(due for due, _, _ in self._paused))
+            next_timeout = max(0, next_timeout - now)
+
+            if not self.sel.get_map():
                 time.sleep(next_timeout)
                 continue
 
-            events = self.sel.select(timeout=next_timeout)
-            for key, mask in events:
-                s = key.fileobj
-                offset = key.data
-                try:
-                    client_conn, addr = s.accept()
-                    client_conn.setblocking(True)
-                    # 提交到线程池处理TCP转发
-                    executor.submit(self.handle_tcp_connection, client_conn, offset, s.getsockname()[1])
-                except Exception as e:
-                    print("接受连接时出错:", e)
+            for key, mask in self.sel.select(timeout=next_timeout):
+                callback, arg = key.data
+                callback(key.fileobj, arg)
 
-    def run_udp(self):
-        print("服务端中间件启动（UDP），动态监听 TOTP 端口并转发数据到目标...")
-        sel_udp = selectors.DefaultSelector()
+    def _pause_listener(self, sock):
+        """暂停监听 ACCEPT_BACKOFF 秒：先从 selector 移除，到期后由事件循环重新注册"""
+        try:
+            key = self.sel.unregister(sock)
+        except (KeyError, ValueError):
+            return
+        self._paused.append((time.monotonic() + ACCEPT_BACKOFF, sock, key.data))
+
+    def _resume_listeners(self, now):
+        """重新注册暂停到期的监听 socket（所属窗口已关闭的直接丢弃）"""
+        paused, self._paused = self._paused, []
+        for due, sock, data in paused:
+            if due > now:
+                self._paused.append((due, sock, data))
+            elif self._slot_in_use(data[1]):
+                self.sel.register(sock, selectors.EVENT_READ, data=data)
+
+    def _accept_connections(self, listener, slot):
+        """监听 socket 可读：一次唤醒取完 backlog 中所有等待的连接，突发连接时减少 select 次数"""
         while True:
-            now = time.time()
-            next_timeout = 5
-
-            # 更新或创建各偏移对应的 UDP socket
-            for offset in self.offsets:
-                port, valid_start, valid_end = self.get_window_params(offset)
-                info = self.sockets.get(offset)
-                if info:
-                    sock, old_valid_start, old_valid_end, old_port = info
-                    if now >= old_valid_end or port != old_port:
-                        try:
-                            sel_udp.unregister(sock)
-                        except Exception:
-                            pass
-                        sock.close()
-                        print(f"[{time.strftime('%H:%M:%S')}] 关闭旧 UDP socket（偏移 {offset}，端口 {old_port}）")
-                        del self.sockets[offset]
-                        info = None
-                if not info:
-                    if now >= valid_start:
-                        try:
-                            s = self.create_udp_socket(port)
-                            sel_udp.register(s, selectors.EVENT_READ, data=offset)
-                            self.sockets[offset] = (s, valid_start, valid_end, port)
-                            print(f"[{time.strftime('%H:%M:%S')}] 创建 UDP socket（偏移 {offset}，端口 {port}），有效期至 {time.strftime('%H:%M:%S', time.localtime(valid_end))}")
-                        except Exception as e:
-                            print(f"创建 UDP 端口 {port} 失败: {e}")
-                    else:
-                        next_timeout = min(next_timeout, valid_start - now)
-
-            for offset, (s, valid_start, valid_end, port) in self.sockets.items():
-                next_timeout = min(next_timeout, valid_end - now)
-
-            events = sel_udp.select(timeout=next_timeout)
-            for key, mask in events:
-                s = key.fileobj
-                offset = key.data
-                try:
-                    data, addr = s.recvfrom(4096)
-                    if data:
-                        threading.Thread(target=self.handle_udp_packet, args=(s, data, addr, offset, s.getsockname()[1])).start()
-                except Exception as e:
-                    print("处理 UDP 数据包时出错:", e)
+            try:
+                client_conn, addr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                if e.errno in ACCEPT_EXHAUSTED:
+                    logger.warning("接受连接失败（%s），暂停 %d 秒", e, ACCEPT_BACKOFF)
+                    self._pause_listener(listener)
+                else:
+                    logger.warning("接受连接时出错: %s", e)
+                break
+            if not self.acquire_connection():
+                logger.warning("连接数已达上限，拒绝来自 %s 的连接", addr)
+                client_conn.close()
+                continue
+            # 提交到线程池处理TCP转发（转发时会改为非阻塞，无需在此设置）
+            self.pool.submit(self.handle_tcp_connection, client_conn, slot.counter, slot.port)
+
+    def _receive_packets(self, sock, slot):
+        """UDP 监听 socket 可读：一次唤醒连续接收多个数据包，复用接收缓冲区"""
+        try:
+            for data, addr in recv_datagrams(sock, self._udp_buf):
+                if data:
+                    self.handle_udp_packet(sock, data, addr, slot.counter, slot.port)
+        except Exception as e:
+            logger.warning("处理 UDP 数据包时出错: %s", e)
+
+    def _relay_replies(self, sock, session):
+        """UDP 会话 socket 可读：把目标的响应转发回客户端"""
+        relay_udp_replies(session, self._udp_buf)
+
+    def _expire_sessions(self, now):
+        expire_udp_sessions(self._udp_sessions, self.sel, now)
+        return now + UDP_SESSION_TIMEOUT
+
+    def run_tcp(self):
+        logger.info("服务端中间件启动（TCP），动态监听 TOTP 端口并转发数据到目标...")
+        if self.upstream_pool > 0:
+            self._upstream_wanted.set()
+            threading.Thread(target=self.refill_upstream_pool, name='upstream-pool', daemon=True).start()
+        self._serve(self.create_tcp_socket, self._accept_connections)
+
+    def run_udp(self):
+        logger.info("服务端中间件启动（UDP），动态监听 TOTP 端口并转发数据到目标...")
+        try:
+            self._udp_target = resolve_udp(self.target_host, self.target_port)
+        except OSError as e:
+            logger.error("解析目标地址 %s 失败: %s", self.target_host, e)
+            sys.exit(1)
+        self._udp_buf = udp_buffer()
+        self._serve(self.create_udp_socket, self._receive_packets, on_tick=self._expire_sessions)
 
 ###############################################################################
 # Client 类（TCP/UDP均支持，TCP部分使用优化后的转发）
 ###############################################################################
-class Client:
+class Client(TotpRoute):
     """
     客户端中间件类：
       - 在本地使用 protocol 监听（客户端接入协议）
@@ -271,176 +1047,196 @@ class Client:
         然后进行数据转发
     """
     def __init__(self, interval, extend, base_port, port_range, secret, offsets,
-                 server_ip, local_listen_port, protocol):
-        self.interval = interval
-        self.extend = extend
-        self.base_port = base_port
-        self.port_range = port_range
-        self.secret = secret
-        self.offsets = offsets
+                 server_ip, local_listen_port, protocol, workers=64, max_connections=4096,
+                 processes=1):
+        super().__init__(interval, extend, base_port, port_range, secret, offsets,
+                         protocol, workers, max_connections, processes)
         self.server_ip = server_ip
         self.local_listen_port = local_listen_port
 
-        self.protocol = protocol.lower()
-        if self.protocol not in ["tcp", "udp"]:
-            raise ValueError("protocol 参数只支持 tcp 或 udp")
+        self._udp_sessions = {}  # 本地客户端地址 -> UdpSession
+        self._udp_server = None  # 解析后的服务器地址 (family, IP)，在 run_udp 中解析
+
+    # 上一个端口多久未连上即并行尝试下一个偏移的端口（秒）
+    CONNECT_STAGGER = 0.25
 
     def get_totp_port(self, t):
-        totp = pyotp.TOTP(self.secret, interval=self.interval)
-        otp = totp.at(t)
-        port_offset = int(otp) % self.port_range
-        return self.base_port + port_offset
+        return self._port_for_counter(int(t) // self.interval)
+
+    def offset_ports(self, now):
+        """返回各偏移当前对应的 [(偏移下标, 端口), ...]；不同偏移可能落在同一窗口，相同端口只保留一次"""
+        result = []
+        seen = set()
+        for i, offset in enumerate(self.offsets):
+            port = self.get_totp_port(now + offset)
+            if port not in seen:
+                seen.add(port)
+                result.append((i, port))
+        return result
 
     def handle_tcp_connection(self, local_conn):
         """
         TCP处理函数：本地应用连接后，
         客户端尝试通过 protocol 连接服务器的TOTP动态端口，并进行双向转发
-        （使用优化后的转发函数）
+        连接过程由转发反应器非阻塞地完成，工作线程不等待：按顺序尝试各偏移对应的端口，
+        前一个端口 CONNECT_STAGGER 秒内未连上时并行尝试下一个，先连上者胜出
         """
-        print(f"[{time.strftime('%H:%M:%S')}] 本地连接来自 {local_conn.getpeername()}")
-        server_conn = None
-        for offset in self.offsets:
-            try:
-                target_time = time.time() + offset
-                port = self.get_totp_port(target_time)
-                print(f"[{time.strftime('%H:%M:%S')}] 尝试连接服务器 {self.server_ip}:{port}（偏移 {offset}）")
-                server_conn = socket.create_connection((self.server_ip, port), timeout=5)
-                set_tcp_options(server_conn)
-                print(f"[{time.strftime('%H:%M:%S')}] 连接成功：{self.server_ip}:{port}")
-                break
-            except Exception as e:
-                print(f"连接 {self.server_ip}:{port} 失败: {e}")
-        if server_conn is None:
-            print("无法连接到服务器的 TOTP 端口")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("本地连接来自 %s", local_conn.getpeername())
+        ports = [port for _, port in self.offset_ports(time.time())]
+        logger.debug("尝试连接服务器 %s 端口 %s", self.server_ip, ports)
+
+        def on_close():
+            logger.debug("本地连接关闭，转发结束。")
+            self.release_connection()
+
+        def on_error(e):
+            logger.warning("无法连接到服务器的 TOTP 端口: %s", e)
+            self.release_connection()
+
+        try:
+            optimized_forward_tcp_to(
+                local_conn, [(self.server_ip, port) for port in ports],
+                on_close=on_close, on_error=on_error, timeout=5, stagger=self.CONNECT_STAGGER)
+        except Exception as e:
+            on_error(e)
             local_conn.close()
-            return
-        optimized_bidirectional_forward_tcp(local_conn, server_conn)
-        local_conn.close()
-        server_conn.close()
-        print(f"[{time.strftime('%H:%M:%S')}] 本地连接关闭，转发结束。")
 
     def handle_udp_packet(self, local_sock, data, client_addr):
         """
-        UDP处理函数：收到本地UDP数据包后，
-        客户端尝试通过 protocol 向服务器发送数据，并将服务器响应转发回本地
-        （此处未做长连接优化，UDP转发原理与TCP不同）
+        UDP处理函数（在事件循环中执行）：收到本地UDP数据包后，
+        经该本地地址的会话 socket 发往服务器的 TOTP 端口，服务器响应由事件循环异步转发回本地。
+        会话的第一个数据包同时发往所有偏移对应的端口，以最先响应的端口所属偏移为准
+        （目标因此可能收到首个数据包的多份副本，其多余的响应由 _accept_reply 丢弃）；
+        此后每个数据包只发送一份；会话从未收到响应且超过 UDP_REPLY_TIMEOUT 秒时换用下一个偏移，
+        已收到过响应的会话不再切换（单向的数据流本就没有响应）
         """
-        print(f"[{time.strftime('%H:%M:%S')}] 本地 UDP 数据包来自 {client_addr}")
-        for offset in self.offsets:
-            try:
-                target_time = time.time() + offset
-                port = self.get_totp_port(target_time)
-                print(f"[{time.strftime('%H:%M:%S')}] 尝试通过 UDP 连接服务器 {self.server_ip}:{port}（偏移 {offset}）")
-                udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                udp_sock.settimeout(5)
-                udp_sock.sendto(data, (self.server_ip, port))
-                response, _ = udp_sock.recvfrom(4096)
-                local_sock.sendto(response, client_addr)
-                print(f"[{time.strftime('%H:%M:%S')}] UDP 转发成功，使用偏移 {offset}")
-                return
-            except Exception as e:
-                print(f"使用偏移 {offset} 连接服务器 {self.server_ip}:{port} 失败: {e}")
-        print("无法通过 UDP 连接到服务器的 TOTP 端口")
+        logger.debug("本地 UDP 数据包来自 %s", client_addr)
+        try:
+            now = time.monotonic()
+            session = self._udp_sessions.get(client_addr)
+            if session is None:
+                udp_sock = socket.socket(self._udp_server[0], socket.SOCK_DGRAM)
+                try:
+                    udp_sock.setblocking(False)
+                    session = UdpSession(udp_sock, local_sock, client_addr)
+                    self.sel.register(udp_sock, selectors.EVENT_READ, data=session)
+                except Exception:
+                    udp_sock.close()
+                    raise
+                self._udp_sessions[client_addr] = session
+                ports = [port for _, port in self.offset_ports(time.time())]
+                session.racing = len(ports) - 1
+            else:
+                if session.race_until is not None:
+                    # 已收到首个响应后本地又发出数据：之后的响应可能是对新数据的应答，不再按副本丢弃
+                    session.racing = 0
+                    session.race_until = None
+                if (not session.replied and session.waiting_since is not None
+                        and now - session.waiting_since > UDP_REPLY_TIMEOUT):
+                    logger.debug("使用偏移 %d 未收到服务器 %s 的响应，换用下一个偏移",
+                                 self.offsets[session.offset_index], self.server_ip)
+                    session.offset_index = (session.offset_index + 1) % len(self.offsets)
+                    session.racing = 0
+                    session.race_until = None
+                    session.waiting_since = None
+                ports = [self.get_totp_port(time.time() + self.offsets[session.offset_index])]
+            for port in ports:
+                session.sock.sendto(data, (self._udp_server[1], port))
+            if session.waiting_since is None:
+                session.waiting_since = now
+            session.last_active = now
+        except Exception as e:
+            logger.warning("无法通过 UDP 连接到服务器的 TOTP 端口: %s", e)
 
-    def run(self):
-        if self.protocol == "tcp":
-            self.run_tcp()
-        elif self.protocol == "udp":
-            self.run_udp()
+    def _relay_replies(self, session, buf):
+        """转发服务器响应，丢弃首个数据包副本的响应以及不属于当前偏移的端口发来的响应"""
+        relay_udp_replies(session, buf, self._accept_reply)
+
+    def _accept_reply(self, session, source):
+        """
+        判断服务器响应是否转发给本地应用：
+        首个数据包发往多个端口时，只转发第一个响应并以其端口所属偏移为准，
+        UDP_RACE_WINDOW 秒内的其余响应（至多为多发的副本数）视为副本的响应丢弃；
+        此后只转发来自当前偏移所在窗口或相邻窗口端口的响应
+        """
+        wall = time.time()
+        if session.racing:
+            now = time.monotonic()
+            if session.race_until is None:
+                session.race_until = now + UDP_RACE_WINDOW
+                for i, port in self.offset_ports(wall):
+                    if port == source[1]:
+                        session.offset_index = i
+                        logger.debug("UDP 会话 %s 使用偏移 %d", session.client_addr, self.offsets[i])
+                        break
+                return True
+            if now < session.race_until:
+                session.racing -= 1
+                return False
+            session.racing = 0
+            session.race_until = None
+        counter = int(wall + self.offsets[session.offset_index]) // self.interval
+        return source[1] in (self._port_for_counter(counter - 1), self._port_for_counter(counter),
+                             self._port_for_counter(counter + 1))
 
     def run_tcp(self):
         try:
-            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            listener.bind(('0.0.0.0', self.local_listen_port))
-            listener.listen(5)
-            print(f"客户端中间件启动（TCP），监听本地端口 {self.local_listen_port}，转发数据至服务器 {self.server_ip}")
+            listener = create_tcp_listener(self.local_listen_port, reuse_port=self.reuse_port)
+            logger.info("客户端中间件启动（TCP），监听本地端口 %d，转发数据至服务器 %s", self.local_listen_port, self.server_ip)
         except Exception as e:
-            print(f"创建监听 socket 失败: {e}")
+            logger.error("创建监听 socket 失败: %s", e)
             sys.exit(1)
         while True:
             try:
                 local_conn, addr = listener.accept()
+                if not self.acquire_connection():
+                    logger.warning("连接数已达上限，拒绝来自 %s 的本地连接", addr)
+                    local_conn.close()
+                    continue
                 local_conn.setblocking(True)
-                executor.submit(self.handle_tcp_connection, local_conn)
+                self.pool.submit(self.handle_tcp_connection, local_conn)
             except Exception as e:
-                print("接受本地连接失败:", e)
+                logger.warning("接受本地连接失败: %s", e)
+                if isinstance(e, OSError) and e.errno in ACCEPT_EXHAUSTED:
+                    # 文件描述符耗尽时 accept 会立即再次失败，稍后再试
+                    time.sleep(ACCEPT_BACKOFF)
 
     def run_udp(self):
         try:
             local_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if self.reuse_port:
+                set_listener_options(local_sock, reuse_port=True)
             local_sock.bind(('0.0.0.0', self.local_listen_port))
             local_sock.setblocking(False)
-            print(f"客户端中间件启动（UDP），监听本地端口 {self.local_listen_port}，转发数据至服务器 {self.server_ip}")
+            logger.info("客户端中间件启动（UDP），监听本地端口 %d，转发数据至服务器 %s", self.local_listen_port, self.server_ip)
         except Exception as e:
-            print(f"创建本地 UDP 监听 socket 失败: {e}")
+            logger.error("创建本地 UDP 监听 socket 失败: %s", e)
+            sys.exit(1)
+        try:
+            family, sockaddr = resolve_udp(self.server_ip, 0)
+        except OSError as e:
+            logger.error("解析服务器地址 %s 失败: %s", self.server_ip, e)
             sys.exit(1)
-        sel_udp = selectors.DefaultSelector()
+        self._udp_server = (family, sockaddr[0])
+        sel_udp = self.sel
         sel_udp.register(local_sock, selectors.EVENT_READ)
+        buf = udp_buffer()
+        sweep_due = time.monotonic() + UDP_SESSION_TIMEOUT
         while True:
-            events = sel_udp.select(timeout=5)
+            events = sel_udp.select(timeout=max(0, sweep_due - time.monotonic()))
             for key, mask in events:
-                sock = key.fileobj
+                if isinstance(key.data, UdpSession):
+                    self._relay_replies(key.data, buf)
+                    continue
                 try:
-                    data, addr = sock.recvfrom(4096)
-                    if data:
-                        threading.Thread(target=self.handle_udp_packet, args=(local_sock, data, addr)).start()
+                    # 一次唤醒连续接收多个数据包，复用接收缓冲区
+                    for data, addr in recv_datagrams(local_sock, buf):
+                        if data:
+                            self.handle_udp_packet(local_sock, data, addr)
                 except Exception as e:
-                    print("接收本地 UDP 数据失败:", e)
-
-###############################################################################
-# 配置加载与主程序
-###############################################################################
-def load_config(config_file):
-    """
-    从 toml 文件加载配置参数  
-    示例配置（config.toml）：
-        interval = 30
-        extend = 15
-        base_port = 3000
-        port_range = 1000
-        secret = "S3K3TPI5MYA2M67V"
-        offsets = [-15, 0, 15]
-        host = "127.0.0.1"      # 服务端模式下为目标地址；客户端模式下为服务器 IP
-        port = 8080             # 服务端模式下为目标端口；客户端模式下为本地监听端口
-        mode = "server"         # server 或 client
-        protocol = "tcp"        # 或 "udp"
-    """
-    try:
-        config = toml.load(config_file)
-        return config
-    except Exception as e:
-        print(f"加载配置文件 {config_file} 失败: {e}")
-        sys.exit(1)
-
-if __name__ == '__main__':
-    # 默认配置文件为 config.toml，也可通过命令行参数指定其他文件
-    config_file = 'config.toml'
-    if len(sys.argv) > 1:
-        config_file = sys.argv[1]
-    config = load_config(config_file)
-
-    interval   = config.get('interval', 30)
-    extend     = config.get('extend', 15)
-    base_port  = config.get('base_port', 3000)
-    port_range = config.get('port_range', 1000)
-    secret     = config.get('secret', '')
-    offsets    = config.get('offsets', [-15, 0, 15])
-    host       = config.get('host', '127.0.0.1')
-    port       = config.get('port', 8080)
-    mode       = config.get('mode', 'server').lower()
-    protocol   = config.get('protocol', 'tcp').lower()
-
-    if mode == 'server':
-        server = Server(interval=interval, extend=extend, base_port=base_port, port_range=port_range,
-                        secret=secret, offsets=offsets, target_host=host, target_port=port,
-                        protocol=protocol)
-        server.run()
-    elif mode == 'client':
-        client = Client(interval=interval, extend=extend, base_port=base_port, port_range=port_range,
-                        secret=secret, offsets=offsets, server_ip=host, local_listen_port=port,
-                        protocol=protocol)
-        client.run()
-    else:
-        print("无效的 mode 配置，请设置为 'server' 或 'client'")
-        sys.exit(1)
+                    logger.warning("接收本地 UDP 数据失败: %s", e)
+            now = time.monotonic()
+            if now >= sweep_due:
+                expire_udp_sessions(self._udp_sessions, sel_udp, now)
+                sweep_due = now + UDP_SESSION_TIMEOUT